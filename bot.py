@@ -5,15 +5,102 @@ import docker
 import secrets
 from urllib.parse import urljoin
 import asyncio
-
-from database import ContainerDB
-from config import DISCORD_TOKEN, TERMINAL_SERVICE_URL, is_authorized
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+try:
+    import uvloop
+except ImportError:  # optional; not available on Windows
+    uvloop = None
+
+from database import close_db, get_db
+from config import (
+    DISCORD_TOKEN,
+    DOCKER_POOL_SIZE,
+    LIST_CACHE_TTL,
+    PULL_POOL_SIZE,
+    TERMINAL_SERVICE_URL,
+    TERMINAL_TOKEN_SECRET,
+    is_authorized,
+)
 
 # Initialize Docker client
 docker_client = docker.from_env()
 
-# Initialize database
-db = ContainerDB()
+# Dedicated pools for blocking Docker SDK calls: quick daemon calls and the
+# /list status fan-out use fast_pool, while slow registry pulls get their own
+# pool so they can't hold up interactive commands
+fast_pool = ThreadPoolExecutor(max_workers=DOCKER_POOL_SIZE, thread_name_prefix="docker-fast")
+pull_pool = ThreadPoolExecutor(max_workers=PULL_POOL_SIZE, thread_name_prefix="docker-pull")
+
+# Seconds between sweeps of expired terminal tokens
+TOKEN_SWEEP_INTERVAL = 60
+
+# Discord message limits
+EMBED_MAX_FIELDS = 25
+MESSAGE_MAX_EMBEDS = 10
+MESSAGE_MAX_EMBED_CHARS = 6000
+
+# Container status cache for /list: container_id -> (status, fetched_at)
+_status_cache: Dict[str, Tuple[str, float]] = {}
+_refresh_lock = asyncio.Lock()
+_refresh_task: Optional[asyncio.Task] = None
+
+# Images confirmed present locally during this process's lifetime
+_known_images: Set[str] = set()
+
+
+async def _refresh_statuses(container_ids: List[str]):
+    """Fetch container statuses from Docker and update the status cache."""
+    async with _refresh_lock:
+        # Skip anything a concurrent refresh already updated while we waited
+        now = time.monotonic()
+        container_ids = [
+            container_id for container_id in container_ids
+            if container_id not in _status_cache
+            or now - _status_cache[container_id][1] >= LIST_CACHE_TTL
+        ]
+        if not container_ids:
+            return
+
+        run_in_executor = asyncio.get_running_loop().run_in_executor
+        results = await asyncio.gather(
+            *[
+                run_in_executor(
+                    fast_pool,
+                    docker_client.containers.get,
+                    container_id
+                )
+                for container_id in container_ids
+            ],
+            return_exceptions=True
+        )
+
+        fetched_at = time.monotonic()
+        for container_id, result in zip(container_ids, results):
+            status = "not found" if isinstance(result, Exception) else result.status
+            _status_cache[container_id] = (status, fetched_at)
+
+
+def _schedule_refresh(container_ids: List[str]):
+    """Start a background status refresh unless one is already running."""
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.create_task(_refresh_statuses(container_ids))
+
+
+async def ensure_image(image: str):
+    """Make sure an image is available locally, pulling it only if missing."""
+    if image in _known_images:
+        return
+
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(fast_pool, docker_client.images.get, image)
+    except docker.errors.ImageNotFound:
+        await loop.run_in_executor(pull_pool, docker_client.images.pull, image)
+    _known_images.add(image)
 
 
 class DockerBot(commands.Bot):
@@ -21,16 +108,35 @@ class DockerBot(commands.Bot):
         intents = discord.Intents.default()
         intents.message_content = True
         super().__init__(command_prefix='!', intents=intents)
+        self._token_sweeper: Optional[asyncio.Task] = None
 
     async def setup_hook(self):
         """Called when the bot is starting up."""
-        await db.init_db()
+        await get_db()
+        self._token_sweeper = asyncio.create_task(self._sweep_terminal_tokens())
         await self.tree.sync()
         print("Bot is ready!")
 
+    async def _sweep_terminal_tokens(self):
+        """Periodically delete expired terminal tokens."""
+        while True:
+            await asyncio.sleep(TOKEN_SWEEP_INTERVAL)
+            try:
+                db = await get_db()
+                await db.delete_expired_terminal_tokens()
+            except Exception as e:
+                print(f"Failed to sweep expired terminal tokens: {e}")
+
     async def on_ready(self):
         print(f"{self.user} has logged in!")
 
+    async def close(self):
+        """Called when the bot is shutting down."""
+        if self._token_sweeper:
+            self._token_sweeper.cancel()
+        await close_db()
+        await super().close()
+
 
 bot = DockerBot()
 
@@ -65,6 +171,8 @@ async def create_container(
     await interaction.response.defer(ephemeral=True)
 
     try:
+        db = await get_db()
+
         # Check if user already has a container
         existing = await db.get_container_by_user(str(user.id))
         if existing:
@@ -76,24 +184,20 @@ async def create_container(
             return
 
         # Check if container name is already in use
-        all_containers = await db.get_all_containers()
-        if any(c['container_name'] == container_name for c in all_containers):
+        if await db.container_name_exists(container_name):
             await interaction.followup.send(
                 f"❌ Container name `{container_name}` is already in use.",
                 ephemeral=True
             )
             return
 
-        # Pull image if needed (in background thread)
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
-            lambda: docker_client.images.pull(image)
-        )
+        # Pull image if needed
+        await ensure_image(image)
+        loop = asyncio.get_running_loop()
 
         # Create container
         container = await loop.run_in_executor(
-            None,
+            fast_pool,
             lambda: docker_client.containers.create(
                 image=image,
                 name=container_name,
@@ -105,15 +209,26 @@ async def create_container(
         )
 
         # Ensure container is running for terminal access
-        await loop.run_in_executor(None, container.start)
+        await loop.run_in_executor(fast_pool, container.start)
 
-        # Store in database
-        await db.create_container_record(
+        # Store in database; a concurrent /create for the same user may have won the race
+        created = await db.create_container_record(
             discord_user_id=str(user.id),
             container_name=container_name,
             container_id=container.id,
             image=image
         )
+        if not created:
+            await loop.run_in_executor(
+                fast_pool,
+                lambda: container.remove(force=True)
+            )
+            await interaction.followup.send(
+                f"❌ User {user.mention} already has a container.\n"
+                f"Each user can only have ONE container. Destroy the existing one first.",
+                ephemeral=True
+            )
+            return
 
         await interaction.followup.send(
             f"✅ Successfully created container `{container_name}` for {user.mention}\n"
@@ -123,6 +238,8 @@ async def create_container(
         )
 
     except docker.errors.ImageNotFound:
+        # The image may have been removed since we last saw it
+        _known_images.discard(image)
         await interaction.followup.send(
             f"❌ Docker image `{image}` not found.",
             ephemeral=True
@@ -153,38 +270,47 @@ async def destroy_container(
         )
         return
 
-    await interaction.response.defer(ephemeral=True)
-
+    # Check if user has a container before deferring, so a miss costs one response
     try:
-        # Check if user has a container
+        db = await get_db()
         container_record = await db.get_container_by_user(str(user.id))
-        if not container_record:
-            await interaction.followup.send(
-                f"❌ User {user.mention} does not have a container.",
-                ephemeral=True
-            )
-            return
+    except Exception as e:
+        await interaction.response.send_message(
+            f"❌ Error destroying container: {str(e)}",
+            ephemeral=True
+        )
+        return
 
+    if not container_record:
+        await interaction.response.send_message(
+            f"❌ User {user.mention} does not have a container.",
+            ephemeral=True
+        )
+        return
+
+    await interaction.response.defer(ephemeral=True)
+
+    try:
         container_name = container_record['container_name']
         container_id = container_record['container_id']
 
         # Get Docker container
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         try:
             docker_container = await loop.run_in_executor(
-                None,
+                fast_pool,
                 lambda: docker_client.containers.get(container_id)
             )
 
             # Stop and remove container
             if docker_container.status == 'running':
                 await loop.run_in_executor(
-                    None,
+                    fast_pool,
                     docker_container.stop
                 )
             
             await loop.run_in_executor(
-                None,
+                fast_pool,
                 docker_container.remove
             )
 
@@ -194,6 +320,7 @@ async def destroy_container(
 
         # Remove from database
         await db.delete_container_record(str(user.id))
+        _status_cache.pop(container_id, None)
 
         await interaction.followup.send(
             f"✅ Successfully destroyed container `{container_name}` for {user.mention}",
@@ -207,6 +334,25 @@ async def destroy_container(
         )
 
 
+def _batch_embeds(embeds: List[discord.Embed]) -> List[List[discord.Embed]]:
+    """Group embeds into batches that fit within a single Discord message."""
+    batches: List[List[discord.Embed]] = []
+    batch: List[discord.Embed] = []
+    batch_chars = 0
+    for embed in embeds:
+        if batch and (
+            len(batch) == MESSAGE_MAX_EMBEDS
+            or batch_chars + len(embed) > MESSAGE_MAX_EMBED_CHARS
+        ):
+            batches.append(batch)
+            batch, batch_chars = [], 0
+        batch.append(embed)
+        batch_chars += len(embed)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
 @bot.tree.command(name="list", description="List all containers")
 async def list_containers(interaction: discord.Interaction):
     """List all containers in the database."""
@@ -220,6 +366,7 @@ async def list_containers(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True)
 
     try:
+        db = await get_db()
         containers = await db.get_all_containers()
         
         if not containers:
@@ -229,38 +376,59 @@ async def list_containers(interaction: discord.Interaction):
             )
             return
 
-        embed = discord.Embed(
-            title="📋 Container List",
-            description=f"Total containers: {len(containers)}",
-            color=discord.Color.blue()
-        )
+        # Serve cached statuses, refreshing in the background once stale.
+        # Only block on Docker when a container has never been looked up.
+        container_ids = [c['container_id'] for c in containers]
+        if any(container_id not in _status_cache for container_id in container_ids):
+            await _refresh_statuses(container_ids)
+            stale = False
+        else:
+            now = time.monotonic()
+            stale = any(
+                now - _status_cache[container_id][1] >= LIST_CACHE_TTL
+                for container_id in container_ids
+            )
+            if stale:
+                _schedule_refresh(container_ids)
 
-        loop = asyncio.get_event_loop()
+        fields = []
         for container_record in containers:
             user_id = container_record['discord_user_id']
             container_name = container_record['container_name']
-            container_id = container_record['container_id']
             image = container_record['image']
 
-            # Get container status from Docker
-            try:
-                docker_container = await loop.run_in_executor(
-                    None,
-                    lambda: docker_client.containers.get(container_id)
-                )
-                status = docker_container.status
-                status_emoji = "🟢" if status == "running" else "🔴"
-            except docker.errors.NotFound:
-                status = "not found"
+            status = _status_cache[container_record['container_id']][0]
+            if status == "not found":
                 status_emoji = "⚠️"
+            else:
+                status_emoji = "🟢" if status == "running" else "🔴"
 
-            embed.add_field(
-                name=f"{status_emoji} {container_name}",
-                value=f"**User:** <@{user_id}>\n**Image:** {image}\n**Status:** {status}",
-                inline=False
-            )
+            fields.append({
+                "name": f"{status_emoji} {container_name}",
+                "value": f"**User:** <@{user_id}>\n**Image:** {image}\n**Status:** {status}",
+                "inline": False
+            })
+
+        # Discord caps an embed at 25 fields, so split large fleets across embeds
+        embeds = [
+            discord.Embed.from_dict({
+                "color": discord.Color.blue().value,
+                "fields": fields[i:i + EMBED_MAX_FIELDS]
+            })
+            for i in range(0, len(fields), EMBED_MAX_FIELDS)
+        ]
+        embeds[0].title = "📋 Container List"
+        embeds[0].description = f"Total containers: {len(containers)}"
+
+        cache_age = time.monotonic() - min(
+            _status_cache[container_id][1] for container_id in container_ids
+        )
+        embeds[-1].set_footer(
+            text=f"Status {'stale, refreshing' if stale else 'cached'} · {cache_age:.0f}s old"
+        )
 
-        await interaction.followup.send(embed=embed, ephemeral=True)
+        for batch in _batch_embeds(embeds):
+            await interaction.followup.send(embeds=batch, ephemeral=True)
 
     except Exception as e:
         await interaction.followup.send(
@@ -280,28 +448,37 @@ async def container_status(interaction: discord.Interaction, user: discord.User)
         )
         return
 
-    await interaction.response.defer(ephemeral=True)
-
+    # Check if user has a container before deferring, so a miss costs one response
     try:
+        db = await get_db()
         container_record = await db.get_container_by_user(str(user.id))
-        
-        if not container_record:
-            await interaction.followup.send(
-                f"❌ User {user.mention} does not have a container.",
-                ephemeral=True
-            )
-            return
+    except Exception as e:
+        await interaction.response.send_message(
+            f"❌ Error checking status: {str(e)}",
+            ephemeral=True
+        )
+        return
 
+    if not container_record:
+        await interaction.response.send_message(
+            f"❌ User {user.mention} does not have a container.",
+            ephemeral=True
+        )
+        return
+
+    await interaction.response.defer(ephemeral=True)
+
+    try:
         container_name = container_record['container_name']
         container_id = container_record['container_id']
         image = container_record['image']
         created_at = container_record['created_at']
 
         # Get container status from Docker
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         try:
             docker_container = await loop.run_in_executor(
-                None,
+                fast_pool,
                 lambda: docker_client.containers.get(container_id)
             )
             status = docker_container.status
@@ -318,7 +495,7 @@ async def container_status(interaction: discord.Interaction, user: discord.User)
         embed.add_field(name="Container Name", value=container_name, inline=True)
         embed.add_field(name="Image", value=image, inline=True)
         embed.add_field(name="Status", value=status, inline=True)
-        embed.add_field(name="Created At", value=created_at, inline=True)
+        embed.add_field(name="Created At", value=f"<t:{created_at}:f>", inline=True)
         embed.add_field(name="Container ID", value=container_id[:12], inline=True)
 
         await interaction.followup.send(embed=embed, ephemeral=True)
@@ -335,6 +512,7 @@ async def terminal(interaction: discord.Interaction):
         await interaction.response.send_message("Unauthorized.", ephemeral=True)
         return
 
+    db = await get_db()
     container = await db.get_container_by_user(str(interaction.user.id))
     if not container:
         await interaction.response.send_message("You have no container.", ephemeral=True)
@@ -364,5 +542,12 @@ if __name__ == "__main__":
         print("Please create a .env file with your Discord bot token.")
         exit(1)
 
+    if not TERMINAL_TOKEN_SECRET:
+        print("❌ TERMINAL_TOKEN_SECRET not found in environment variables!")
+        print("Set it in your .env file to the same value the terminal service uses.")
+        exit(1)
+
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     bot.run(DISCORD_TOKEN)
 
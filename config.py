@@ -4,12 +4,17 @@ from dotenv import load_dotenv
 load_dotenv()
 
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
-AUTHORIZED_USERS = [
+AUTHORIZED_USERS = frozenset(
     user_id.strip()
     for user_id in os.getenv("AUTHORIZED_USERS", "").split(",")
     if user_id.strip()
-]
+)
 TERMINAL_SERVICE_URL = os.getenv("TERMINAL_SERVICE_URL", "http://localhost:5000")
+TERMINAL_TOKEN_SECRET = os.getenv("TERMINAL_TOKEN_SECRET", "")
+LIST_CACHE_TTL = float(os.getenv("LIST_CACHE_TTL", "5"))
+# LIST_POOL_SIZE is the setting's older name and is still honoured as a fallback
+DOCKER_POOL_SIZE = int(os.getenv("DOCKER_POOL_SIZE", os.getenv("LIST_POOL_SIZE", "16")))
+PULL_POOL_SIZE = int(os.getenv("PULL_POOL_SIZE", "2"))
 
 def is_authorized(user_id: str) -> bool:
     """Check if a user ID is in the authorized users list."""
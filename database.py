@@ -1,71 +1,124 @@
+import asyncio
+import hashlib
+import time
 import aiosqlite
 from typing import Optional, List, Dict
-from datetime import datetime, timedelta
+
+from config import TERMINAL_TOKEN_SECRET
+
+# blake2b keys are capped at 64 bytes, so derive a fixed-size key from the secret
+_TOKEN_KEY = hashlib.blake2b(TERMINAL_TOKEN_SECRET.encode(), digest_size=32).digest()
+
+
+def hash_token(token: str) -> str:
+    """Hash a terminal token for storage and comparison."""
+    return hashlib.blake2b(token.encode(), digest_size=16, key=_TOKEN_KEY).hexdigest()
 
 
 class ContainerDB:
     def __init__(self, db_path: str = "containers.db"):
         self.db_path = db_path
+        self._conn: Optional[aiosqlite.Connection] = None
+        # SQLite serializes writers anyway; keep our own writes from interleaving
+        # their execute/commit pairs on the shared connection
+        self._write_lock = asyncio.Lock()
 
     async def init_db(self):
-        """Initialize the database and create tables."""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS containers (
-                    discord_user_id TEXT PRIMARY KEY,
-                    container_name TEXT NOT NULL,
-                    container_id TEXT NOT NULL UNIQUE,
-                    image TEXT NOT NULL,
-                    created_at TIMESTAMP NOT NULL
-                )
-            """)
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS terminal_tokens (
-                    container_id TEXT PRIMARY KEY,
-                    token TEXT NOT NULL,
-                    expires_at TIMESTAMP NOT NULL,
-                    FOREIGN KEY(container_id) REFERENCES containers(container_id) ON DELETE CASCADE
-                )
-            """)
-            await db.commit()
+        """Open the shared connection and create tables. Safe to call more than once."""
+        if self._conn is not None:
+            return
+        self._conn = await aiosqlite.connect(self.db_path)
+        self._conn.row_factory = aiosqlite.Row
+        # The bot and terminal service share this file; wait for the other
+        # process's write lock instead of failing immediately
+        await self._conn.execute("PRAGMA busy_timeout=5000")
+        # WAL + NORMAL avoids an fsync per commit; mmap lets reads skip read() syscalls
+        await self._conn.execute("PRAGMA journal_mode=WAL")
+        await self._conn.execute("PRAGMA synchronous=NORMAL")
+        await self._conn.execute("PRAGMA mmap_size=268435456")
+        await self._conn.execute("PRAGMA temp_store=MEMORY")
+        await self._conn.execute("PRAGMA cache_size=-32000")
+        await self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS containers (
+                discord_user_id TEXT PRIMARY KEY,
+                container_name TEXT NOT NULL,
+                container_id TEXT NOT NULL UNIQUE,
+                image TEXT NOT NULL,
+                created_at INTEGER NOT NULL
+            )
+        """)
+        await self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS terminal_tokens (
+                container_id TEXT PRIMARY KEY,
+                token TEXT NOT NULL,
+                expires_at INTEGER NOT NULL,
+                FOREIGN KEY(container_id) REFERENCES containers(container_id) ON DELETE CASCADE
+            )
+        """)
+        # Timestamps used to be stored as ISO strings; convert them to Unix seconds.
+        # Legacy tokens can simply be dropped, users re-issue them with /terminal.
+        await self._conn.execute("""
+            UPDATE containers SET created_at = CAST(strftime('%s', created_at) AS INTEGER)
+            WHERE typeof(created_at) = 'text'
+        """)
+        await self._conn.execute(
+            "DELETE FROM terminal_tokens WHERE typeof(expires_at) = 'text'"
+        )
+        await self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_containers_name ON containers(container_name)"
+        )
+        await self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_tokens_expires ON terminal_tokens(expires_at)"
+        )
+        await self._conn.commit()
+
+    async def aclose(self):
+        """Close the shared connection."""
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
 
     async def get_container_by_user(self, discord_user_id: str) -> Optional[Dict]:
         """Get container information for a Discord user."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                "SELECT * FROM containers WHERE discord_user_id = ?",
-                (discord_user_id,)
-            ) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    return {
-                        "discord_user_id": row["discord_user_id"],
-                        "container_name": row["container_name"],
-                        "container_id": row["container_id"],
-                        "image": row["image"],
-                        "created_at": row["created_at"]
-                    }
-                return None
+        async with self._conn.execute(
+            "SELECT * FROM containers WHERE discord_user_id = ?",
+            (discord_user_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+            if row:
+                return {
+                    "discord_user_id": row["discord_user_id"],
+                    "container_name": row["container_name"],
+                    "container_id": row["container_id"],
+                    "image": row["image"],
+                    "created_at": row["created_at"]
+                }
+            return None
 
     async def get_container_by_container_id(self, container_id: str) -> Optional[Dict]:
         """Get container information by container ID."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                "SELECT * FROM containers WHERE container_id = ?",
-                (container_id,)
-            ) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    return {
-                        "discord_user_id": row["discord_user_id"],
-                        "container_name": row["container_name"],
-                        "container_id": row["container_id"],
-                        "image": row["image"],
-                        "created_at": row["created_at"]
-                    }
-                return None
+        async with self._conn.execute(
+            "SELECT * FROM containers WHERE container_id = ?",
+            (container_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+            if row:
+                return {
+                    "discord_user_id": row["discord_user_id"],
+                    "container_name": row["container_name"],
+                    "container_id": row["container_id"],
+                    "image": row["image"],
+                    "created_at": row["created_at"]
+                }
+            return None
+
+    async def container_name_exists(self, name: str) -> bool:
+        """Check whether a container name is already in use."""
+        async with self._conn.execute(
+            "SELECT 1 FROM containers WHERE container_name = ? LIMIT 1",
+            (name,)
+        ) as cursor:
+            return await cursor.fetchone() is not None
 
     async def create_container_record(
         self,
@@ -73,79 +126,114 @@ class ContainerDB:
         container_name: str,
         container_id: str,
         image: str
-    ):
-        """Create a new container record."""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
+    ) -> bool:
+        """Create a new container record.
+
+        Returns False without inserting if the user or container ID already has a record.
+        """
+        async with self._write_lock:
+            async with self._conn.execute("""
                 INSERT INTO containers (discord_user_id, container_name, container_id, image, created_at)
                 VALUES (?, ?, ?, ?, ?)
-            """, (discord_user_id, container_name, container_id, image, datetime.utcnow().isoformat()))
-            await db.commit()
+                ON CONFLICT DO NOTHING
+                RETURNING discord_user_id
+            """, (discord_user_id, container_name, container_id, image, int(time.time()))) as cursor:
+                row = await cursor.fetchone()
+            await self._conn.commit()
+            return row is not None
 
     async def delete_container_record(self, discord_user_id: str):
         """Delete a container record."""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
+        async with self._write_lock:
+            await self._conn.execute(
                 "DELETE FROM containers WHERE discord_user_id = ?",
                 (discord_user_id,)
             )
-            await db.commit()
+            await self._conn.commit()
 
     async def get_all_containers(self) -> List[Dict]:
         """Get all container records."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute("SELECT * FROM containers") as cursor:
-                rows = await cursor.fetchall()
-                return [
-                    {
-                        "discord_user_id": row["discord_user_id"],
-                        "container_name": row["container_name"],
-                        "container_id": row["container_id"],
-                        "image": row["image"],
-                        "created_at": row["created_at"]
-                    }
-                    for row in rows
-                ]
+        async with self._conn.execute("SELECT * FROM containers") as cursor:
+            rows = await cursor.fetchall()
+            return [
+                {
+                    "discord_user_id": row["discord_user_id"],
+                    "container_name": row["container_name"],
+                    "container_id": row["container_id"],
+                    "image": row["image"],
+                    "created_at": row["created_at"]
+                }
+                for row in rows
+            ]
 
     async def store_terminal_token(self, container_id: str, token: str, expiry: int = 3600):
-        """Store or update a terminal token for a container."""
-        expires_at = (datetime.utcnow() + timedelta(seconds=expiry)).isoformat()
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
+        """Store or update a terminal token for a container. Only its hash is persisted."""
+        expires_at = int(time.time()) + expiry
+        async with self._write_lock:
+            await self._conn.execute("""
                 INSERT INTO terminal_tokens (container_id, token, expires_at)
                 VALUES (?, ?, ?)
                 ON CONFLICT(container_id) DO UPDATE SET token = excluded.token, expires_at = excluded.expires_at
-            """, (container_id, token, expires_at))
-            await db.commit()
+            """, (container_id, hash_token(token), expires_at))
+            await self._conn.commit()
 
     async def get_terminal_token(self, container_id: str) -> Optional[Dict]:
-        """Retrieve a valid terminal token for a container."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                "SELECT token, expires_at FROM terminal_tokens WHERE container_id = ?",
-                (container_id,)
-            ) as cursor:
-                row = await cursor.fetchone()
-                if not row:
-                    return None
+        """Retrieve a valid terminal token hash for a container."""
+        async with self._conn.execute(
+            "SELECT token, expires_at FROM terminal_tokens WHERE container_id = ?",
+            (container_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if not row:
+            return None
 
-                if datetime.fromisoformat(row["expires_at"]) < datetime.utcnow():
-                    await self.delete_terminal_token(container_id)
-                    return None
+        # Expired rows are left for delete_expired_terminal_tokens to sweep
+        if row["expires_at"] < time.time():
+            return None
 
-                return {
-                    "token": row["token"],
-                    "expires_at": row["expires_at"]
-                }
+        return {
+            "token": row["token"],
+            "expires_at": row["expires_at"]
+        }
 
     async def delete_terminal_token(self, container_id: str):
         """Remove a terminal token for a container."""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
+        async with self._write_lock:
+            await self._conn.execute(
                 "DELETE FROM terminal_tokens WHERE container_id = ?",
                 (container_id,)
             )
-            await db.commit()
+            await self._conn.commit()
+
+    async def delete_expired_terminal_tokens(self):
+        """Remove all expired terminal tokens in a single sweep."""
+        async with self._write_lock:
+            await self._conn.execute(
+                "DELETE FROM terminal_tokens WHERE expires_at < ?",
+                (int(time.time()),)
+            )
+            await self._conn.commit()
+
+
+_db: Optional[ContainerDB] = None
+_db_lock = asyncio.Lock()
+
+
+async def get_db() -> ContainerDB:
+    """Return this process's shared ContainerDB, initializing it on first use."""
+    global _db
+    if _db is None:
+        async with _db_lock:
+            if _db is None:
+                db = ContainerDB()
+                await db.init_db()
+                _db = db
+    return _db
+
 
+async def close_db():
+    """Close this process's shared ContainerDB, if it was opened."""
+    global _db
+    if _db is not None:
+        await _db.aclose()
+        _db = None
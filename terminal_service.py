@@ -1,37 +1,123 @@
 import asyncio
+import hmac
 import os
 import socket
 import subprocess
 import threading
 import time
-from typing import Dict
+from typing import Any, Coroutine, Dict, Optional, Set
 
 import docker
 from flask import Flask, abort, jsonify, redirect, request
 
-from database import ContainerDB
+try:
+    import uvloop
+except ImportError:  # optional; not available on Windows
+    uvloop = None
+
+from config import TERMINAL_TOKEN_SECRET
+from database import get_db, hash_token
 
 SESSION_TIMEOUT = int(os.getenv("TERMINAL_SESSION_TIMEOUT", "3600"))
 TTYD_PATH = os.getenv("TTYD_PATH", "ttyd")
 DEFAULT_SHELL = os.getenv("TERMINAL_SHELL", "/bin/bash")
+PORT_POOL_SIZE = int(os.getenv("TERMINAL_PORT_POOL_SIZE", "64"))
+# Seconds ttyd gets to start accepting connections
+TTYD_STARTUP_TIMEOUT = 5.0
 
 app = Flask(__name__)
-db = ContainerDB()
 docker_client = docker.from_env()
 active_sessions: Dict[str, Dict] = {}
 
+# Ports reserved for ttyd sessions: idle ones wait in port_pool, ports handed
+# to a running ttyd are tracked in ports_in_use until its process exits
+port_pool: Set[int] = set()
+ports_in_use: Set[int] = set()
+port_lock = threading.Lock()
+
+# Long-lived event loop for database calls, so the shared aiosqlite
+# connection survives across requests
+event_loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+threading.Thread(target=event_loop.run_forever, daemon=True).start()
+
+
+def run_async(coro: Coroutine[Any, Any, Any]) -> Any:
+    """Run a coroutine on the background event loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, event_loop).result()
+
 
 def init_database():
     """Ensure database tables exist before handling requests."""
-    asyncio.run(db.init_db())
+    run_async(get_db())
+
+
+async def fetch_terminal_token(container_id: str) -> Optional[Dict]:
+    """Look up the stored terminal token for a container."""
+    db = await get_db()
+    return await db.get_terminal_token(container_id)
 
 
 def get_free_port() -> int:
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind(("", 0))
         return s.getsockname()[1]
 
 
+def port_is_free(port: int) -> bool:
+    """Check that nothing else is bound to a port by briefly binding it ourselves."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(("", port))
+        except OSError:
+            return False
+        return True
+
+
+def init_port_pool():
+    """Reserve a pool of ports to hand out to ttyd sessions."""
+    with port_lock:
+        for _ in range(PORT_POOL_SIZE):
+            port = get_free_port()
+            if port not in ports_in_use:
+                port_pool.add(port)
+
+
+def acquire_port() -> int:
+    """Take a free port from the pool, falling back to a fresh one if none is left.
+
+    Pooled ports aren't held open while idle, so something else may have bound
+    one since it was reserved; those are dropped from the pool.
+    """
+    with port_lock:
+        while port_pool:
+            port = port_pool.pop()
+            if port_is_free(port):
+                break
+        else:
+            port = get_free_port()
+            while port in ports_in_use:
+                port = get_free_port()
+        ports_in_use.add(port)
+        return port
+
+
+def release_port(port: int):
+    """Return a port to the pool once its ttyd process has exited."""
+    with port_lock:
+        if port in ports_in_use:
+            ports_in_use.remove(port)
+            port_pool.add(port)
+
+
+def discard_port(port: int):
+    """Drop a port that ttyd failed to start on so it is not handed out again."""
+    with port_lock:
+        ports_in_use.discard(port)
+        port_pool.discard(port)
+
+
 def container_exists(container_id: str) -> bool:
     try:
         docker_client.containers.get(container_id)
@@ -40,29 +126,85 @@ def container_exists(container_id: str) -> bool:
         return False
 
 
-def _watch_session(container_id: str, process: subprocess.Popen):
-    """Wait for the ttyd process to exit and clean up session mapping."""
+def _cleanup_session(
+    container_id: str, process: subprocess.Popen, port: int, launched_at: float
+):
+    """Reap an exited ttyd process and clean up its session mapping and port."""
     process.wait()
-    active_sessions.pop(container_id, None)
+    session = active_sessions.get(container_id)
+    if session and session["process"] is process:
+        active_sessions.pop(container_id, None)
+
+    # ttyd failing right after launch usually means something else holds the port
+    if process.returncode != 0 and time.monotonic() - launched_at < TTYD_STARTUP_TIMEOUT:
+        discard_port(port)
+    else:
+        release_port(port)
+
+
+def _on_ttyd_exit(
+    pidfd: int, container_id: str, process: subprocess.Popen, port: int, launched_at: float
+):
+    event_loop.remove_reader(pidfd)
+    os.close(pidfd)
+    _cleanup_session(container_id, process, port, launched_at)
+
+
+def _watch_session(
+    container_id: str, process: subprocess.Popen, port: int, launched_at: float
+):
+    """Clean up the session once the ttyd process exits.
+
+    Where pidfds are available (Linux 5.3+) the exit is watched by the
+    background event loop, so sessions don't each hold a waiting thread.
+    """
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        threading.Thread(
+            target=_cleanup_session,
+            args=(container_id, process, port, launched_at),
+            daemon=True,
+        ).start()
+        return
+
+    event_loop.call_soon_threadsafe(
+        event_loop.add_reader,
+        pidfd,
+        _on_ttyd_exit,
+        pidfd,
+        container_id,
+        process,
+        port,
+        launched_at,
+    )
 
 
 def wait_for_port(port: int, timeout: float = 5.0) -> bool:
     """Wait until a local port starts accepting TCP connections."""
-    deadline = time.time() + timeout
-    while time.time() < deadline:
+    deadline = time.monotonic() + timeout
+    # Back off exponentially so a fast-starting ttyd is detected within a few ms
+    delay = 0.005
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        # A socket whose connect() failed can't portably be reused, so open a
+        # fresh one per attempt
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.settimeout(0.5)
+            sock.settimeout(min(0.5, remaining))
             try:
                 sock.connect(("127.0.0.1", port))
                 return True
             except (ConnectionRefusedError, socket.timeout):
-                time.sleep(0.1)
-    return False
+                pass
+        time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+        delay = min(delay * 2, 0.1)
 
 
 def launch_ttyd(container_id: str) -> Dict:
     """Launch ttyd bound to docker exec for the container."""
-    port = get_free_port()
+    port = acquire_port()
     command = [
         TTYD_PATH,
         "--port",
@@ -75,20 +217,29 @@ def launch_ttyd(container_id: str) -> Dict:
         DEFAULT_SHELL,
     ]
 
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    active_sessions[container_id] = {
+    launched_at = time.monotonic()
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        release_port(port)
+        raise
+    session = {
         "process": process,
         "port": port,
         "started_at": time.time(),
     }
-    threading.Thread(target=_watch_session, args=(container_id, process), daemon=True).start()
+    active_sessions[container_id] = session
+    _watch_session(container_id, process, port, launched_at)
 
-    if not wait_for_port(port):
+    # Catch a ttyd that died during startup
+    if not wait_for_port(port, TTYD_STARTUP_TIMEOUT) or process.poll() is not None:
+        discard_port(port)
         process.terminate()
-        active_sessions.pop(container_id, None)
+        if active_sessions.get(container_id) is session:
+            active_sessions.pop(container_id, None)
         raise RuntimeError("Failed to start ttyd session")
 
-    return active_sessions[container_id]
+    return session
 
 
 def get_or_launch_session(container_id: str) -> Dict:
@@ -120,8 +271,8 @@ def terminal(container_id: str):
         abort(400, "token query parameter is required")
 
     # Validate token
-    token_record = asyncio.run(db.get_terminal_token(container_id))
-    if not token_record or token_record["token"] != token:
+    token_record = run_async(fetch_terminal_token(container_id))
+    if not token_record or not hmac.compare_digest(token_record["token"], hash_token(token)):
         abort(403, "invalid or expired token")
 
     # Ensure container exists
@@ -140,6 +291,12 @@ def terminal(container_id: str):
 
 
 if __name__ == "__main__":
+    if not TERMINAL_TOKEN_SECRET:
+        print("❌ TERMINAL_TOKEN_SECRET not found in environment variables!")
+        print("Set it in your .env file to the same value the Discord bot uses.")
+        exit(1)
+
     init_database()
+    init_port_pool()
     app.run(host="0.0.0.0", port=int(os.getenv("TERMINAL_SERVICE_PORT", "5000")))
 